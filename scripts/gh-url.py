@@ -11,7 +11,8 @@ Usage:
 When README_ABSOLUTE_URLS=1 is set, generates absolute GitHub URLs instead of
 relative paths. This is used during PyPI package builds to ensure links work
 correctly on PyPI's README display. Requires being on a git tag when this
-environment variable is set.
+environment variable is set, unless $MDCMD_GH_BASE_URL provides a pre-resolved
+base URL.
 """
 
 import sys
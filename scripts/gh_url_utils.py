@@ -4,11 +4,18 @@
 import os
 import subprocess
 import sys
+from functools import lru_cache
 
+# Pre-resolved base URL (e.g. exported once by CI), to skip a `git describe` per script invocation
+BASE_URL_VAR = "MDCMD_GH_BASE_URL"
 
+
+@lru_cache(maxsize=1)
 def get_github_base_url():
     """Get the appropriate GitHub base URL based on environment."""
     if os.getenv("README_ABSOLUTE_URLS"):
+        if base_url := os.getenv(BASE_URL_VAR):
+            return base_url
         try:
             result = subprocess.run(
                 ["git", "describe", "--exact-match", "--tags", "HEAD"],
@@ -29,4 +36,8 @@ def format_url(path, base_url=None):
     """Format a URL as either absolute or relative."""
     if base_url:
         return f"{base_url}/{path}"
-    return path
\ No newline at end of file
+    return path
+
+if __name__ == "__main__":
+    # Print the base URL (empty, for relative URLs), e.g. for CI to resolve once and export as $MDCMD_GH_BASE_URL
+    print(get_github_base_url() or "")
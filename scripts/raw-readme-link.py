@@ -6,7 +6,8 @@ Usage:
     python scripts/raw-readme-link.py toc
     
 Finds the relevant section in README.md and generates a link with line numbers.
-When README_ABSOLUTE_URLS=1 is set, generates absolute GitHub URLs.
+When README_ABSOLUTE_URLS=1 is set, generates absolute GitHub URLs (using
+$MDCMD_GH_BASE_URL, if set, instead of resolving the current tag).
 """
 
 import sys
@@ -19,36 +20,32 @@ from gh_url_utils import get_github_base_url, format_url
 
 def find_readme_lines(section):
     """Find line numbers for the relevant section in README.md."""
+    # Map section names to their command patterns
+    patterns = {
+        "mdcmd": "<!-- `bmdf seq 3` -->",
+        "toc": "<!-- `toc` -->"
+    }
+
+    if section not in patterns:
+        return None
+
+    pattern = patterns[section]
+
     try:
-        content = Path("README.md").read_text()
-        lines = content.splitlines()
-        
-        # Map section names to their command patterns
-        patterns = {
-            "mdcmd": "<!-- `bmdf seq 3` -->",
-            "toc": "<!-- `toc` -->"
-        }
-        
-        if section not in patterns:
-            return None
-            
-        pattern = patterns[section]
-        
-        # Find the pattern and determine the end based on content type
-        for i, line in enumerate(lines, 1):
-            if pattern in line:
-                # For mdcmd example, find until closing ```
-                if section == "mdcmd":
-                    for j in range(i+1, len(lines)+1):
-                        if j > len(lines) or lines[j-1] == "```":
-                            return (i, j)
-                # For toc, find until empty line
-                else:
-                    for j in range(i+1, len(lines)+1):
-                        if j > len(lines):
-                            return (i, j-1)
-                        if not lines[j-1].strip():
-                            return (i, j-1)
+        # Stream lines, stopping as soon as the section's end is found
+        with open("README.md", "r") as f:
+            lines = (line.rstrip("\n") for line in f)
+            for i, line in enumerate(lines, 1):
+                if pattern in line:
+                    for j, line in enumerate(lines, i + 1):
+                        # For mdcmd example, find until closing ```
+                        if section == "mdcmd":
+                            if line == "```":
+                                return (i, j)
+                        # For toc, find until empty line
+                        elif not line.strip():
+                            return (i, j - 1)
+                    return None
     except:
         pass
     return None
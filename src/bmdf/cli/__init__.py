@@ -1,17 +1,20 @@
 import shlex
 import sys
+from functools import lru_cache
+from io import StringIO
 from os import chdir
-from subprocess import PIPE, Popen, CalledProcessError
+from shutil import which
+from subprocess import DEVNULL, PIPE, Popen, CalledProcessError
 from sys import stdout
 from typing import Optional, Tuple, Any, IO
 
 from click import argument, command, option, get_current_context, echo, BadParameter, UsageError
-from utz import env, proc
+from utz import env
 from utz.process import pipeline
 from utz.process.cmd import Cmd
 
 from bmdf import utils
-from bmdf.utils import COPY_BINARIES, details, fence, quote
+from bmdf.utils import COPY_BINARIES, Log, details, fence, quote
 
 BMDF_ERR_FMT_VAR = 'BMDF_ERR_FMT'
 BMDF_ERR_FMT = env.get(BMDF_ERR_FMT_VAR)
@@ -32,6 +35,64 @@ LEVEL_STYLES = [ 'comment', 'bash', 'split', 'details', ]
 STYLES = [ *LEVEL_STYLES, 'console', ]
 
 
+def _print_commented_lines(lines: list[str], log: Log):
+    for line in lines:
+        log(f'# {line}' if line else '#')
+
+
+def _print_fenced_lines(lines: list[str], log: Log, typ: str = None):
+    with fence(typ=typ, log=log):
+        for line in lines:
+            log(line)
+
+
+def _render_comment(lines: list[str], cmd_str: str, log: Log, fence_type: Optional[str]):
+    _print_commented_lines(lines, log)
+
+
+def _render_bash(lines: list[str], cmd_str: str, log: Log, fence_type: Optional[str]):
+    with fence('bash', log=log):
+        log(cmd_str)
+        _print_commented_lines(lines, log)
+
+
+def _render_split(lines: list[str], cmd_str: str, log: Log, fence_type: Optional[str]):
+    with fence('bash', log=log):
+        log(cmd_str)
+    _print_fenced_lines(lines, log, typ=fence_type)
+
+
+def _render_details(lines: list[str], cmd_str: str, log: Log, fence_type: Optional[str]):
+    with details(code=cmd_str, log=log):
+        _print_fenced_lines(lines, log, typ=fence_type)
+
+
+def _render_console(lines: list[str], cmd_str: str, log: Log, fence_type: Optional[str]):
+    with fence(fence_type or 'console', log=log):
+        log(f'$ {cmd_str}')
+        for line in lines:
+            log(line)
+
+
+# Output renderers, by style name
+RENDERERS = {
+    'comment': _render_comment,
+    'bash': _render_bash,
+    'split': _render_split,
+    'details': _render_details,
+    'console': _render_console,
+}
+
+
+@lru_cache(maxsize=1)
+def _which_copy() -> Optional[str]:
+    """Return the first available clipboard-copy executable from `COPY_BINARIES`, if any."""
+    for cmd in COPY_BINARIES:
+        if path := which(cmd):
+            return path
+    return None
+
+
 def resolve_style(value: str) -> str:
     """Resolve a `-y/--style` value to a canonical style name.
 
@@ -155,6 +216,8 @@ def bmd(
 
     try:
         with env(env_opts):
+            # `both` merges stderr into stdout at the fd level (`stderr=STDOUT`); pipes already use Popen's default
+            # (block-buffered) `bufsize=-1`
             output = pipeline(cmds, both=include_stderr)
             returncode = 0
     except CalledProcessError as e:
@@ -170,13 +233,9 @@ def bmd(
             print(stderr, file=sys.stderr)
         returncode = e.returncode
 
-    lines = [
-        line.rstrip('\n')
-        for line in
-        output.split('\n')
-    ]
+    lines = output.split('\n')
     if lines and not lines[-1]:
-        lines = lines[:-1]
+        lines.pop()
     if returncode and error_fmt:
         try:
             error_line = error_fmt % returncode
@@ -196,19 +255,17 @@ def bmd(
         cmd_str,
     ])
 
-    out_lines = []
-
-    def log(line=''):
-        out_lines.append(utils.strip_ansi(line) if strip_ansi else line)
+    # Write directly to the output file, unless the output also needs to be copied to the clipboard
+    file = file or stdout
+    copy_cmd = None if no_copy else _which_copy()
+    out = StringIO() if copy_cmd else file
 
-    def print_commented_lines():
-        for line in lines:
-            log(f'# {line}' if line else '#')
+    logged = False
 
-    def print_fenced_lines(typ: str = None):
-        with fence(typ=typ, log=log):
-            for line in lines:
-                log(line)
+    def log(line=''):
+        nonlocal logged
+        logged = True
+        out.write((utils.strip_ansi(line) if strip_ansi else line) + '\n')
 
     if style is not None:
         style = resolve_style(style)
@@ -221,40 +278,20 @@ def bmd(
             raise ValueError(f"Pass -f/--fence at most {len(LEVEL_STYLES) - 1}x")
         style = LEVEL_STYLES[fence_level]
 
-    if style == 'comment':
-        print_commented_lines()
-    elif style == 'bash':
-        with fence('bash', log=log):
-            log(cmd_str)
-            print_commented_lines()
-    elif style == 'split':
-        with fence('bash', log=log):
-            log(cmd_str)
-        print_fenced_lines(typ=fence_type)
-    elif style == 'details':
-        with details(code=cmd_str, log=log):
-            print_fenced_lines(typ=fence_type)
-    elif style == 'console':
-        with fence(fence_type or 'console', log=log):
-            log(f'$ {cmd_str}')
-            for line in lines:
-                log(line)
-    else:
+    renderer = RENDERERS.get(style)
+    if renderer is None:
         raise ValueError(f"Unknown style: {style!r}")
-
-    output = '\n'.join(out_lines)
-    if not no_copy:
-        copy_cmd = None
-        for cmd in COPY_BINARIES:
-            if proc.check('which', cmd, log=None):
-                copy_cmd = cmd
-                break
-        if copy_cmd:
-            p = Popen([copy_cmd], stdin=PIPE, stdout=PIPE, stderr=PIPE, text=True)
-            p.communicate(input=output)
-
-    file = file or stdout
-    print(output, file=file)
+    renderer(lines, cmd_str, log, fence_type)
+    if not logged:
+        # Empty output (e.g. `bmd true`) still prints one (blank) line
+        log()
+
+    if copy_cmd:
+        output = out.getvalue()
+        # With only stdin piped, `communicate` is a plain write + close (that ignores EPIPE, if the copy command exits early)
+        p = Popen([copy_cmd], stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL, bufsize=-1, text=True)
+        p.communicate(input=output.removesuffix('\n'))
+        file.write(output)
     if exit_code is not None:
         # Expected exit code specified: exit 0 if it matches, 1 otherwise
         if returncode != exit_code:
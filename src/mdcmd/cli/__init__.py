@@ -1,51 +1,173 @@
 from __future__ import annotations
 
 import asyncio
-from asyncio import gather
 import re
 import shlex
-from collections.abc import Coroutine
+import sys
+from collections.abc import Awaitable, Iterator, Sequence
 from contextlib import contextmanager
-from functools import partial
-from os import environ as env, rename, getcwd
+from functools import lru_cache
+from itertools import dropwhile
+from os import cpu_count, environ as env, rename, getcwd
 from os.path import basename, exists, join
+from subprocess import PIPE
 from tempfile import TemporaryDirectory
-from typing import Any, Callable, Generator, Optional
+from typing import BinaryIO, Callable, Generator, NamedTuple, Optional
 
-from click import command, option, argument
-from utz import err, Patterns, proc
+from click import IntRange, command, option, argument
+from utz import err, Patterns
 from utz.cli import inc_exc, multi
+from utz.rgx import Includes
 
 from bmdf.utils import amend_opt, amend_check, amend_run, inplace_opt, no_cwd_tmpdir_opt
 
 CMD_LINE_RGX = re.compile(r'<!-- `(?P<cmd>.+)` -->')
-HTML_OPEN_RGX = re.compile(r'<(?P<tag>\w+)(?: +\w+(?:="[^"]*")?)* *>.*')
-LINK_DEF_RGX = re.compile(r'^\[(?P<ref>[^\]]+)\]: (?P<url>.+)$')
-Write = Callable[[str], None]
+# First line of the block following a command line; alternatives are tried in order, and `lastgroup` names the block type
+BLOCK_START_RGX = re.compile(
+    r'(?P<html><(?P<tag>\w+)(?: +\w+(?:="[^"]*")?)* *>.*)'
+    r'|(?P<fence>```.*)'
+    r'|(?P<list>- .*)'
+    r'|(?P<link_def>\[(?P<ref>[^\]]+)\]: (?P<url>.+))'
+    r'|(?P<empty>)'
+)
+LIST_CONT_RGX = re.compile(r'^ {2,}')
+Write = Callable[[str | bytes], None]
+
+
+class Command(NamedTuple):
+    """A command from a ``<!-- `cmd` -->`` line: its raw text (as matched by ``-x``/``-X``/``-u`` patterns), and ``argv``."""
+    cmd_str: str
+    argv: tuple[str, ...]
+
+
+# A line to pass through unchanged, or a command whose output should be embedded
+Segment = str | Command
 
 DEFAULT_FILE_ENV_VAR = 'MDCMD_DEFAULT_PATH'
 DEFAULT_FILE = 'README.md'
 
+DEFAULT_MAX_CONCURRENCY = min(32, (cpu_count() or 1) * 4)
+
 
 class CommandError:
     """Marker class to indicate a command failed."""
-    def __init__(self, cmd: str | list[str], returncode: int, output: bytes | None = None):
+    def __init__(self, cmd: str | Sequence[str], returncode: int, output: bytes | None = None):
         self.cmd = cmd
         self.returncode = returncode
         self.output = output
 
 
-async def async_text(cmd: str | list[str], env: dict | None = None) -> str | CommandError:
-    from subprocess import CalledProcessError
-    try:
-        text = await proc.aio.text(cmd, env=env)
-        return text.rstrip('\n')
-    except CalledProcessError as e:
-        return CommandError(cmd, e.returncode, e.output)
+async def async_bytes(cmd: str | Sequence[str], env: dict | None = None) -> bytes | CommandError:
+    """Run a command (a ``str`` is run in a shell), and return its stdout, or a ``CommandError`` if it fails.
+
+    Output is read in one ``communicate`` call (rather than line-by-line, as ``utz.proc.aio`` does), and left undecoded,
+    to be written straight to the (binary) output file.
+    """
+    if isinstance(cmd, str):
+        err(f'Running: {cmd}')
+        p = await asyncio.create_subprocess_shell(cmd, stdout=PIPE, env=env)
+    else:
+        err(f'Running: {shlex.join(cmd)}')
+        p = await asyncio.create_subprocess_exec(*cmd, stdout=PIPE, env=env)
+    output, _ = await p.communicate()
+    if p.returncode:
+        return CommandError(cmd, p.returncode, output)
+    return output.rstrip(b'\n')
 
 
-async def async_line(arg: str) -> str:
-    return arg
+@lru_cache(maxsize=512)
+def split_cmd(cmd_str: str) -> tuple[str, ...]:
+    """``shlex.split`` a command string (memoized, as READMEs often repeat commands)."""
+    return tuple(shlex.split(cmd_str))
+
+
+def read_lines(path: str) -> list[str]:
+    """Read the lines of a UTF-8 file (or stdin, if ``path`` is "-"), without trailing newlines.
+
+    Splits on "\\n" only (unlike ``str.splitlines``, which also breaks on e.g. form-feeds), matching iteration over a text-mode file.
+    Input is decoded as UTF-8 regardless of locale, matching ``line_writer``'s encoding of the output.
+    """
+    if path == '-':
+        sys.stdin.reconfigure(encoding='utf-8')
+        text = sys.stdin.read()
+    else:
+        with open(path, 'r', encoding='utf-8') as fd:
+            text = fd.read()
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def parse_blocks(
+    lines: Iterator[str],
+    dry_run: bool,
+    patterns: Patterns,
+) -> Generator[Segment, None, None]:
+    """Parse Markdown lines into ``Segment``s: lines to pass through as-is, and commands (whose existing output blocks
+    are skipped) to run, and embed the output of."""
+    for line in lines:
+        yield line
+        if not (m := CMD_LINE_RGX.match(line)):
+            continue
+
+        cmd_str = m.group('cmd')
+        if patterns and not patterns(cmd_str):
+            continue
+
+        if dry_run:
+            err(f"Would run: {cmd_str}")
+            continue
+
+        cmd = split_cmd(cmd_str)
+
+        is_link_def = False
+        try:
+            line = next(lines)
+            block_match = BLOCK_START_RGX.fullmatch(line)
+            block_type = block_match.lastgroup if block_match else None
+            if block_type == 'html':
+                tag = block_match['tag']
+                close_lines = [f"</{tag}>"]
+            elif block_type == 'fence':
+                if cmd[0] == "bmdff":
+                    close_lines = ["```", re.compile(r"```\w+"), "```"]  # Skip two fences
+                else:
+                    close_lines = ["```"]
+            elif block_type == 'list':
+                # Markdown list block - skip all list items
+                skip_lines = []
+                while line and (line.startswith("- ") or LIST_CONT_RGX.match(line)):
+                    skip_lines.append(line)
+                    try:
+                        line = next(lines)
+                    except StopIteration:
+                        break
+                close_lines = None
+            elif block_type == 'link_def':
+                # Link definition block - skip until empty line or non-link-def line
+                is_link_def = True
+                close_lines = None
+            elif block_type == 'empty':
+                close_lines = None
+            else:
+                raise ValueError(f'Unexpected block start line under cmd {cmd}: {line}')
+        except StopIteration:
+            close_lines = None
+
+        while close_lines:
+            close, *close_lines = close_lines
+            # Consume lines through the closing line: for a `str`, the first line equal to it; for a `Pattern`, the first
+            # line after any that match it
+            try:
+                next(dropwhile(close.fullmatch if isinstance(close, re.Pattern) else close.__ne__, lines))
+            except StopIteration:
+                raise ValueError(f'Unclosed block under cmd {cmd_str}: expected {close!r}')
+
+        yield Command(cmd_str, cmd)
+        # Don't add blank line after link definitions
+        if close_lines is None and not is_link_def:
+            yield ""
 
 
 async def process_path(
@@ -54,111 +176,71 @@ async def process_path(
     patterns: Patterns,
     write_fn: Write,
     concurrent: bool = True,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    cache: bool = True,
+    uncached: Patterns | None = None,
 ) -> list[CommandError]:
-    blocks: list[Coroutine[None, None, str | CommandError]] = []
-    def write(arg: str | Coroutine[Any, Any, str | CommandError]):
-        blocks.append(async_line(arg) if isinstance(arg, str) else arg)
-
-    with open(path, 'r') as fd:
-        lines = map(lambda line: line.rstrip('\n'), fd)
-        for line in lines:
-            write(line)
-            if not (m := CMD_LINE_RGX.match(line)):
-                continue
-
-            cmd_str = m.group('cmd')
-            if patterns and not patterns(cmd_str):
-                continue
-
-            if dry_run:
-                err(f"Would run: {cmd_str}")
-                continue
-
-            cmd = shlex.split(cmd_str)
-            # Set environment variable for the current markdown file
-            import os
-            cmd_env = os.environ.copy()
-            cmd_env['MDCMD_FILE'] = path
-
-            is_link_def = False
-            try:
-                line = next(lines)
-                if html_match := HTML_OPEN_RGX.fullmatch(line):
-                    tag = html_match['tag']
-                    close_lines = [f"</{tag}>"]
-                elif line.startswith("```"):
-                    if cmd[0] == "bmdff":
-                        close_lines = ["```", re.compile(r"```\w+"), "```"]  # Skip two fences
-                    else:
-                        close_lines = ["```"]
-                elif line.startswith("- "):
-                    # Markdown list block - skip all list items
-                    skip_lines = []
-                    while line and (line.startswith("- ") or re.match(r"^ {2,}", line)):
-                        skip_lines.append(line)
-                        try:
-                            line = next(lines)
-                        except StopIteration:
-                            break
-                    close_lines = None
-                elif LINK_DEF_RGX.match(line):
-                    # Link definition block - skip until empty line or non-link-def line
-                    is_link_def = True
-                    close_lines = None
-                elif not line:
-                    close_lines = None
-                else:
-                    raise ValueError(f'Unexpected block start line under cmd {cmd}: {line}')
-            except StopIteration:
-                close_lines = None
-
-            while close_lines:
-                close, *close_lines = close_lines
-                line = next(lines)
-                while close.fullmatch(line) if isinstance(close, re.Pattern) else line != close:
-                    line = next(lines)
-
-            write(async_text(cmd, env=cmd_env))
-            # Don't add blank line after link definitions
-            if close_lines is None and not is_link_def:
-                write("")
+    # Plain lines are stored as-is; only commands become awaitables (scheduled up front, in concurrent mode)
+    blocks: list[str | Awaitable[bytes | CommandError]] = []
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def guarded_bytes(cmd: tuple[str, ...], env: dict) -> bytes | CommandError:
+        async with sem:
+            return await async_bytes(cmd, env=env)
+
+    # Identical commands (within this file, which share one env and cwd) run once, and reuse the result; commands
+    # matching `uncached` (e.g. with nondeterministic output) always re-run
+    results: dict[tuple[str, ...], asyncio.Future[bytes | CommandError]] = {}
+
+    async def cached_bytes(cmd: Command, env: dict) -> bytes | CommandError:
+        argv = cmd.argv
+        if not cache or (uncached and uncached(cmd.cmd_str)):
+            return await guarded_bytes(argv, env=env)
+        if argv not in results:
+            results[argv] = asyncio.ensure_future(guarded_bytes(argv, env=env))
+        return await results[argv]
+
+    # Environment for each command, including the current markdown file (if not stdin); shared across commands (not mutated)
+    cmd_env = { **env, 'MDCMD_FILE': path } if path != '-' else env
+
+    # Parse the whole file before starting any commands, so that a parse error doesn't leave subprocesses running
+    segments = list(parse_blocks(iter(read_lines(path)), dry_run=dry_run, patterns=patterns))
+    for segment in segments:
+        if isinstance(segment, str):
+            blocks.append(segment)
+        elif concurrent:
+            blocks.append(asyncio.ensure_future(cached_bytes(segment, env=cmd_env)))
+        else:
+            blocks.append(cached_bytes(segment, env=cmd_env))
 
     errors: list[CommandError] = []
-    if concurrent:
-        gathered = await gather(*blocks)
-        for line in gathered:
-            if isinstance(line, CommandError):
-                errors.append(line)
-                err(f"Command failed with exit code {line.returncode}: {line.cmd if isinstance(line.cmd, str) else ' '.join(line.cmd)}")
-                if line.output:
-                    output_str = line.output.decode() if isinstance(line.output, bytes) else line.output
-                    # Only show first few lines of output to avoid clutter
-                    output_lines = output_str.rstrip('\n').split('\n')
-                    if len(output_lines) > 5:
-                        err(f"Output (first 5 lines):\n" + '\n'.join(output_lines[:5]))
-                    else:
-                        err(f"Output:\n{output_str.rstrip()}")
-            else:
-                write_fn(line)
-    else:
-        for block in blocks:
-            line = await block
-            if isinstance(line, CommandError):
-                errors.append(line)
-                err(f"Command failed with exit code {line.returncode}: {line.cmd if isinstance(line.cmd, str) else ' '.join(line.cmd)}")
-                if line.output:
-                    output_str = line.output.decode() if isinstance(line.output, bytes) else line.output
-                    output_lines = output_str.rstrip('\n').split('\n')
-                    if len(output_lines) > 5:
-                        err(f"Output (first 5 lines):\n" + '\n'.join(output_lines[:5]))
-                    else:
-                        err(f"Output:\n{output_str.rstrip()}")
-            else:
-                write_fn(line)
+    for block in blocks:
+        line = block if isinstance(block, str) else await block
+        if isinstance(line, CommandError):
+            errors.append(line)
+            err(f"Command failed with exit code {line.returncode}: {line.cmd if isinstance(line.cmd, str) else ' '.join(line.cmd)}")
+            if line.output:
+                output_str = line.output.decode() if isinstance(line.output, bytes) else line.output
+                # Only show first few lines of output to avoid clutter
+                output_lines = output_str.rstrip('\n').split('\n')
+                if len(output_lines) > 5:
+                    err(f"Output (first 5 lines):\n" + '\n'.join(output_lines[:5]))
+                else:
+                    err(f"Output:\n{output_str.rstrip()}")
+        else:
+            write_fn(line)
 
     return errors
 
 
+def line_writer(fd: BinaryIO) -> Write:
+    """Write lines to a binary file; ``str`` lines are UTF-8 encoded, command output ``bytes`` are written as-is."""
+    def write(line: str | bytes):
+        fd.write(line if isinstance(line, bytes) else line.encode('utf-8'))
+        fd.write(b'\n')
+    return write
+
+
 @contextmanager
 def out_fd(
     inplace: bool,
@@ -171,21 +253,24 @@ def out_fd(
             raise ValueError('Cannot specify both --inplace and an output path')
         with TemporaryDirectory(dir=dir) as tmpdir:
             tmp_path = join(tmpdir, basename(path))
-            with open(tmp_path, 'w') as f:
-                yield partial(print, file=f)
+            with open(tmp_path, 'wb') as f:
+                yield line_writer(f)
             rename(tmp_path, path)
     else:
         if not out_path or out_path == '-':
-            yield print
+            yield line_writer(sys.stdout.buffer)
         else:
-            with open(out_path, 'w') as f:
-                yield partial(print, file=f)
+            with open(out_path, 'wb') as f:
+                yield line_writer(f)
 
 
 @command('mdcmd')
 @amend_opt
 @option('-C', '--no-concurrent', is_flag=True, help='Run commands in sequence (by default, they are run concurrently)')
 @inplace_opt
+@option('-j', '--max-concurrency', type=IntRange(min=1), default=DEFAULT_MAX_CONCURRENCY, help='Maximum number of commands to run at once, when running concurrently (default: 4x the number of CPUs, at most 32)')
+@option('-N', '--no-cache', is_flag=True, help="Re-run repeated commands (by default, identical commands in a file are run once, and their output reused)")
+@option('-u', '--uncached', 'uncached_strs', multiple=True, help="Always re-run commands matching these regular expressions (e.g. ones with nondeterministic output, like `date`), even when they repeat")
 @option('-n', '--dry-run', is_flag=True, help="Print the commands that would be run, but don't execute them")
 @no_cwd_tmpdir_opt
 @inc_exc(
@@ -198,6 +283,9 @@ def main(
     amend: bool,
     no_concurrent: bool,
     inplace: Optional[bool],
+    max_concurrency: int,
+    no_cache: bool,
+    uncached_strs: tuple[str, ...],
     dry_run: bool,
     no_cwd_tmpdir: bool,
     patterns: Patterns,
@@ -207,6 +295,7 @@ def main(
     """Parse a Markdown file, updating blocks preceded by <!-- `[cmd...]` --> delimiters.
 
     If no paths are provided, will look for a README.md, and operate "in-place" (same as ``mdcmd -i README.md``).
+    PATH and OUT_PATH can be "-", for stdin/stdout.
     """
     if not path:
         path = env.get(DEFAULT_FILE_ENV_VAR, DEFAULT_FILE)
@@ -215,6 +304,9 @@ def main(
         if inplace is None:
             inplace = True
 
+    if path == '-' and inplace:
+        raise ValueError("Can't edit stdin in-place")
+
     amend_check(amend)
 
     tmpdir = None if no_cwd_tmpdir else getcwd()
@@ -226,13 +318,15 @@ def main(
                 patterns=patterns,
                 write_fn=write,
                 concurrent=not no_concurrent,
+                max_concurrency=max_concurrency,
+                cache=not no_cache,
+                uncached=Includes(uncached_strs) if uncached_strs else None,
             )
         )
 
     amend_run(amend)
 
     if errors:
-        import sys
         err(f"\n{len(errors)} command(s) failed")
         sys.exit(1)
 
@@ -0,0 +1,48 @@
+import os
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+from test.utils import ROOT
+
+# RAM-backed tmpfs, used as pytest's temp root where available (unless `--basetemp` or $PYTEST_DEBUG_TEMPROOT is set)
+SHM = '/dev/shm'
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    # Must run before pytest's `tmpdir` plugin resolves `basetemp` (which xdist workers then inherit). Only the root
+    # moves: pytest still creates (and retains, and cleans up) numbered `pytest-of-<user>/pytest-N` dirs under it
+    if (
+        config.option.basetemp is None
+        and 'PYTEST_DEBUG_TEMPROOT' not in os.environ
+        and sys.platform.startswith('linux')
+        and os.path.isdir(SHM)
+        and os.access(SHM, os.W_OK)
+    ):
+        os.environ['PYTEST_DEBUG_TEMPROOT'] = SHM
+
+
+@pytest.fixture(autouse=True, scope="session")
+def _cd_root():
+    """Run tests from the repo root (so e.g. README commands like ``test/scripts/h3.py`` resolve)."""
+    old = os.getcwd()
+    os.chdir(ROOT)
+    yield
+    os.chdir(old)
+
+
+@pytest.fixture(scope="session")
+def shared_tmp(tmp_path_factory) -> Path:
+    """Temporary directory shared by all tests in the session (each test gets a subdirectory, via ``test_dir``)."""
+    return tmp_path_factory.mktemp("mdcmd")
+
+
+@pytest.fixture
+def test_dir(shared_tmp: Path, request) -> Path:
+    """Fresh subdirectory of ``shared_tmp``, named after the current test."""
+    path = shared_tmp / re.sub(r'[^\w.-]+', '_', request.node.name)
+    path.mkdir()
+    return path
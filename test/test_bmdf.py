@@ -108,6 +108,12 @@ def test_styles(kwargs, expected):
     assert file.getvalue().rstrip('\n').split('\n') == expected
 
 
+def test_empty_output():
+    file = StringIO()
+    bmd.callback(['true'], no_copy=True, file=file)
+    assert file.getvalue() == "\n"
+
+
 @parametrize(
     "value,expected",
     [
@@ -1,52 +1,17 @@
 from os.path import join, relpath
-from tempfile import TemporaryDirectory
+from pathlib import Path
 
+import pytest
 from click.testing import CliRunner
-from utz import cd
 
-from mdcmd.cli import main
-from test.utils import DATA, ROOT
+from mdcmd.cli import Command, main, parse_blocks, read_lines
+from test.utils import DATA, write_file
 
+parametrize = pytest.mark.parametrize
 
-def test_mdcmd():
-    with cd(ROOT):
-        runner = CliRunner()
-        with TemporaryDirectory() as tmpdir:
-            in_path = join(DATA, 'README.md')
-            out_path = join(tmpdir, 'README.md')
-            res = runner.invoke(main, [in_path, out_path])
-            assert res.exit_code == 0
-            with (
-                open(in_path, 'r', encoding='utf-8') as in_fd,
-                open(out_path, 'r', encoding='utf-8') as out_fd,
-            ):
-                assert in_fd.read() == out_fd.read()
-
-
-def test_mdcmd_command_failure():
-    """Test that mdcmd exits with non-zero code when commands fail."""
-    with cd(ROOT):
-        runner = CliRunner()
-        with TemporaryDirectory() as tmpdir:
-            # Create a markdown file with a failing command
-            in_path = join(tmpdir, 'test.md')
-            out_path = join(tmpdir, 'output.md')
-            with open(in_path, 'w') as f:
-                f.write('# Test\n\n<!-- `false` -->\n```\nold\n```\n')
-
-            res = runner.invoke(main, [in_path, out_path], catch_exceptions=False)
-            assert res.exit_code == 1
-
-
-def test_mdcmd_mixed_success_failure():
-    """Test that mdcmd continues processing after failures and reports all errors."""
-    with cd(ROOT):
-        runner = CliRunner()
-        with TemporaryDirectory() as tmpdir:
-            in_path = join(tmpdir, 'test.md')
-            out_path = join(tmpdir, 'output.md')
-            with open(in_path, 'w') as f:
-                f.write('''# Test
+# Markdown inputs: a failing command, and failing + succeeding commands
+_FAIL_MD = b'# Test\n\n<!-- `false` -->\n```\nold\n```\n'
+_MIXED_MD = b'''# Test
 
 <!-- `echo "first"` -->
 ```
@@ -62,31 +27,156 @@ old
 ```
 old
 ```
-''')
-
-            res = runner.invoke(main, [in_path, out_path], catch_exceptions=False)
-            assert res.exit_code == 1
-
-            # Verify successful commands still wrote output
-            with open(out_path) as f:
-                file_output = f.read()
-                assert 'first' in file_output
-                assert 'third' in file_output
-
-
-def test_mdcmd_no_crash_on_error():
-    """Test that mdcmd doesn't crash with traceback on command failure."""
-    with cd(ROOT):
-        runner = CliRunner()
-        with TemporaryDirectory() as tmpdir:
-            in_path = join(tmpdir, 'test.md')
-            out_path = join(tmpdir, 'output.md')
-            with open(in_path, 'w') as f:
-                f.write('# Test\n\n<!-- `false` -->\n```\nold\n```\n')
-
-            # Use catch_exceptions=True (default) to catch exceptions
-            # If there's an uncaught exception, it will be in res.exception
-            res = runner.invoke(main, [in_path, out_path])
-            assert res.exit_code == 1
-            # Should not have an uncaught exception
-            assert res.exception is None or not isinstance(res.exception, Exception)
+'''
+
+# Shared by all tests; each `invoke` sets up its own isolated I/O
+_RUNNER = CliRunner()
+
+# Expected outputs of `test_mdcmd{,_readme}` (which are also their inputs); read once, at import, and compared as bytes
+_TINY = (Path(DATA) / 'tiny.md').read_bytes()
+_README = (Path(DATA) / 'README.md').read_bytes()
+
+
+def test_mdcmd():
+    """Test that a small file, with each kind of output block (and only cheap commands), round-trips unchanged."""
+    res = _RUNNER.invoke(main, ['-', '-'], input=_TINY)
+    assert res.exit_code == 0
+    assert res.stdout_bytes == _TINY
+
+
+@pytest.mark.slow
+def test_mdcmd_readme():
+    res = _RUNNER.invoke(main, ['-', '-'], input=_README)
+    assert res.exit_code == 0
+    assert res.stdout_bytes == _README
+
+
+def test_mdcmd_command_failure():
+    """Test that mdcmd exits with non-zero code when commands fail, without crashing with a traceback."""
+    # Use catch_exceptions=True (default) to catch exceptions
+    # If there's an uncaught exception, it will be in res.exception
+    res = _RUNNER.invoke(main, ['-', '-'], input=_FAIL_MD)
+    assert res.exit_code == 1
+    # Should not have an uncaught exception
+    assert res.exception is None or not isinstance(res.exception, Exception)
+
+
+def test_mdcmd_mixed_success_failure():
+    """Test that mdcmd continues processing after failures and reports all errors."""
+    res = _RUNNER.invoke(main, ['-', '-'], input=_MIXED_MD, catch_exceptions=False)
+    assert res.exit_code == 1
+
+    # Verify successful commands still wrote output
+    output_lines = res.stdout.split('\n')
+    assert 'first' in output_lines
+    assert 'third' in output_lines
+
+
+@parametrize(
+    "md,msg",
+    [
+        # Unrecognized block under a command (after an earlier, valid command)
+        (b'<!-- `echo a` -->\n```\nold\n```\n\n<!-- `echo x` -->\nbogus\n', 'Unexpected block start line'),
+        # Unclosed fence at EOF
+        (b'<!-- `echo a` -->\n```\nold\n', "Unclosed block under cmd echo a: expected '```'"),
+    ],
+)
+def test_mdcmd_parse_error(md, msg):
+    """Test that mdcmd raises (rather than hanging) when parsing fails after earlier commands."""
+    res = _RUNNER.invoke(main, ['-', '-'], input=md)
+    assert isinstance(res.exception, ValueError)
+    assert msg in str(res.exception)
+
+
+def test_parse_blocks():
+    """Test that parse_blocks yields commands in place of their existing output blocks."""
+    lines = [
+        '# Test',
+        '',
+        '<!-- `echo "a b"` -->',
+        '```',
+        'old',
+        '```',
+        '',
+        '<!-- `seq 3` -->',
+        '',
+        'text',
+    ]
+    segments = list(parse_blocks(iter(lines), dry_run=False, patterns=None))
+    assert segments == [
+        '# Test',
+        '',
+        '<!-- `echo "a b"` -->',
+        Command('echo "a b"', ('echo', 'a b')),
+        '',
+        '<!-- `seq 3` -->',
+        Command('seq 3', ('seq', '3')),
+        '',
+        'text',
+    ]
+
+
+@parametrize("fence_type", ['', 'text'])
+def test_parse_blocks_bmdff(fence_type):
+    """Test that parse_blocks skips both of a `bmdff` block's fences (with or without a typed output fence)."""
+    lines = [
+        '<!-- `bmdff seq 2` -->',
+        '```bash',
+        'seq 2',
+        '```',
+        f'```{fence_type}',
+        '1',
+        '2',
+        '```',
+        '',
+        'text',
+    ]
+    segments = list(parse_blocks(iter(lines), dry_run=False, patterns=None))
+    assert segments == [
+        '<!-- `bmdff seq 2` -->',
+        Command('bmdff seq 2', ('bmdff', 'seq', '2')),
+        '',
+        'text',
+    ]
+
+
+def test_read_lines(test_dir):
+    """Test that read_lines strips exactly one trailing newline, and only splits on "\\n"."""
+    path = join(test_dir, 'test.md')
+    for text, expected in [
+        ('', []),
+        ('a', ['a']),
+        ('a\n', ['a']),
+        ('a\n\n', ['a', '']),
+        ('a\fb\n', ['a\fb']),
+        ('é\n', ['é']),
+    ]:
+        write_file(path, text.encode())
+        assert read_lines(path) == expected
+
+
+@parametrize(
+    "args,reused",
+    [
+        ([], True),
+        (['-N'], False),
+        (['-u', '^python '], False),
+        (['-u', '^echo '], True),
+        # Patterns match the command as written in the Markdown (like `-x`/`-X`), not a re-quoted form of it
+        (['-u', '-c "import uuid'], False),
+    ],
+)
+def test_mdcmd_cache(args, reused, test_dir):
+    """Test that repeated commands run once (and share output), unless caching is disabled for them."""
+    in_path = join(test_dir, 'test.md')
+    out_path = join(test_dir, 'output.md')
+    cmd = '<!-- `python -c "import uuid; print(uuid.uuid4())"` -->'
+    write_file(in_path, f'{cmd}\n\n{cmd}\n\n'.encode())
+
+    res = _RUNNER.invoke(main, [*args, in_path, out_path], catch_exceptions=False)
+    assert res.exit_code == 0
+
+    with open(out_path) as f:
+        lines = f.read().split('\n')
+    assert lines[0] == lines[3] == cmd
+    assert (lines[1] == lines[4]) == reused
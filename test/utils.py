@@ -1,6 +1,16 @@
+import os
 from os.path import dirname, join
 
 TEST = dirname(__file__)
 DATA = join(TEST, 'data')
 
 ROOT = dirname(TEST)
+
+
+def write_file(path: str, data: bytes):
+    """Write ``data`` to ``path`` in one unbuffered ``write(2)``."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)